@@ -0,0 +1,167 @@
+import os
+import logging
+from functools import lru_cache
+from contextlib import asynccontextmanager
+import aiohttp
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from azure.core.pipeline.transport import RequestsTransport, AioHttpTransport
+from azure.search.documents import SearchClient, SearchIndexingBufferedSender
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from azure.search.documents.indexes import SearchIndexClient
+from azure.ai.textanalytics import TextAnalyticsClient
+from azure.ai.textanalytics.aio import TextAnalyticsClient as AsyncTextAnalyticsClient
+from openai import AzureOpenAI, AsyncAzureOpenAI, APIStatusError, APIConnectionError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Connections kept alive per host in the shared pool
+POOL_SIZE = 32
+# Upper bound on simultaneous connections of the async OpenAI client
+OPENAI_MAX_CONNECTIONS = 64
+
+SEARCH_SETTINGS = ("AZURE_SEARCH_ENDPOINT", "AZURE_SEARCH_KEY")
+TEXT_ANALYTICS_SETTINGS = ("AZURE_TEXT_ANALYTICS_ENDPOINT", "AZURE_TEXT_ANALYTICS_KEY")
+OPENAI_SETTINGS = ("AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_KEY", "AZURE_OPENAI_DEPLOYMENT")
+OPENAI_API_VERSION = "2023-05-15"
+# Throttling, request timeouts and transient server errors; the same status codes azure-core retries by default
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+@lru_cache(maxsize=None)
+def load_environment():
+    # Read .env on first use rather than at import, so importing a script costs nothing
+    load_dotenv()
+
+def check_settings(*names):
+    # Validate up front so a missing key is reported cleanly instead of failing inside a client constructor
+    load_environment()
+    missing = [name for name in names if not os.environ.get(name)]
+    if missing:
+        logger.error(f"Missing environment variables: {', '.join(missing)}")
+        logger.error("Please make sure you have a .env file with your Azure endpoints and keys.")
+    return not missing
+
+def is_throttled(exception):
+    # Also covers connections that fail or drop and requests that time out, since the clients
+    # used under throttle_retry no longer retry those themselves
+    if isinstance(exception, (HttpResponseError, APIStatusError)):
+        return exception.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(exception, (ServiceRequestError, ServiceResponseError, APIConnectionError))
+
+# Retries throttled or dropped calls with jittered exponential backoff; works on sync and async functions.
+# Clients whose calls run under it are created with the SDK's own retries turned off (retry_total=0 for
+# the Azure SDKs, max_retries=0 for OpenAI), so a throttled call is not retried by both layers.
+throttle_retry = retry(
+    retry=retry_if_exception(is_throttled),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+
+@lru_cache(maxsize=None)
+def get_transport():
+    # Every synchronous client shares one session, so TLS connections are reused across clients
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount("https://", adapter)
+    return RequestsTransport(session=session, session_owner=False)
+
+@asynccontextmanager
+async def shared_async_transport():
+    # One aiohttp session per event loop shared by every async client, closed when the block exits
+    connector = aiohttp.TCPConnector(limit=POOL_SIZE, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        yield AioHttpTransport(session=session, session_owner=False)
+
+@lru_cache(maxsize=None)
+def get_search_config():
+    load_environment()
+    search_endpoint = os.environ["AZURE_SEARCH_ENDPOINT"]
+    logger.info(f"Azure Search Endpoint: {search_endpoint}")
+    logger.info("Azure Search Key: <redacted>")
+    return search_endpoint, AzureKeyCredential(os.environ["AZURE_SEARCH_KEY"])
+
+@lru_cache(maxsize=None)
+def get_text_analytics_config():
+    load_environment()
+    text_analytics_endpoint = os.environ["AZURE_TEXT_ANALYTICS_ENDPOINT"]
+    logger.info(f"Azure Text Analytics Endpoint: {text_analytics_endpoint}")
+    logger.info("Azure Text Analytics Key: <redacted>")
+    return text_analytics_endpoint, AzureKeyCredential(os.environ["AZURE_TEXT_ANALYTICS_KEY"])
+
+@lru_cache(maxsize=None)
+def get_openai_config():
+    load_environment()
+    openai_endpoint = os.environ["AZURE_OPENAI_ENDPOINT"]
+    openai_deployment = os.environ["AZURE_OPENAI_DEPLOYMENT"]
+    logger.info(f"Azure OpenAI Endpoint: {openai_endpoint}")
+    logger.info("Azure OpenAI Key: <redacted>")
+    logger.info(f"Azure OpenAI Deployment: {openai_deployment}")
+    return openai_endpoint, os.environ["AZURE_OPENAI_KEY"], openai_deployment
+
+def get_openai_deployment():
+    return get_openai_config()[2]
+
+def _search_options(api_version):
+    options = {"transport": get_transport()}
+    if api_version:
+        options["api_version"] = api_version
+    return options
+
+@lru_cache(maxsize=None)
+def get_search_index_client(api_version=None):
+    search_endpoint, search_credential = get_search_config()
+    return SearchIndexClient(endpoint=search_endpoint, credential=search_credential, **_search_options(api_version))
+
+@lru_cache(maxsize=None)
+def get_search_client(index_name, api_version=None):
+    search_endpoint, search_credential = get_search_config()
+    return SearchClient(endpoint=search_endpoint, index_name=index_name, credential=search_credential, retry_total=0, **_search_options(api_version))
+
+@lru_cache(maxsize=None)
+def get_text_analytics_client():
+    text_analytics_endpoint, text_analytics_credential = get_text_analytics_config()
+    return TextAnalyticsClient(endpoint=text_analytics_endpoint, credential=text_analytics_credential, transport=get_transport(), retry_total=0)
+
+@lru_cache(maxsize=None)
+def get_openai_client(api_version=OPENAI_API_VERSION):
+    openai_endpoint, openai_key, _ = get_openai_config()
+    return AzureOpenAI(api_key=openai_key, api_version=api_version, azure_endpoint=openai_endpoint, max_retries=0)
+
+def create_buffered_sender(index_name, api_version=None, **kwargs):
+    # Not cached: the sender is a context manager that flushes and closes when the upload is done
+    search_endpoint, search_credential = get_search_config()
+    return SearchIndexingBufferedSender(
+        endpoint=search_endpoint,
+        index_name=index_name,
+        credential=search_credential,
+        **_search_options(api_version),
+        **kwargs
+    )
+
+# The async factories below are not cached: async clients are bound to the event loop they are used in
+
+def create_async_search_client(index_name, transport=None, **kwargs):
+    # The discovery scripts stream search results outside throttle_retry and keep the SDK retries;
+    # callers that retry the search themselves pass retry_total=0.
+    search_endpoint, search_credential = get_search_config()
+    return AsyncSearchClient(endpoint=search_endpoint, index_name=index_name, credential=search_credential, transport=transport, **kwargs)
+
+def create_async_text_analytics_client(transport=None):
+    text_analytics_endpoint, text_analytics_credential = get_text_analytics_config()
+    return AsyncTextAnalyticsClient(endpoint=text_analytics_endpoint, credential=text_analytics_credential, transport=transport, retry_total=0)
+
+def create_async_openai_client(api_version=OPENAI_API_VERSION):
+    # HTTP/2 multiplexes concurrent requests over a few connections instead of a TLS handshake each.
+    # The OpenAI client closes this httpx client when it is closed.
+    openai_endpoint, openai_key, _ = get_openai_config()
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=POOL_SIZE)
+    )
+    return AsyncAzureOpenAI(api_key=openai_key, api_version=api_version, azure_endpoint=openai_endpoint, http_client=http_client, max_retries=0)
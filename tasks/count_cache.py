@@ -0,0 +1,22 @@
+import os
+from functools import lru_cache
+from diskcache import Cache
+
+CACHE_DIR = ".count_cache"
+# Cached counts expire after a day; set CACHE_VERSION to a new value after rebuilding the index
+# or changing how search hits are selected for the prompt
+CACHE_EXPIRE = 86400
+
+@lru_cache(maxsize=None)
+def get_cache():
+    return Cache(CACHE_DIR)
+
+def make_key(index_name, query_incident, system_message, user_prompt_template, model):
+    return (os.getenv("CACHE_VERSION", "1"), index_name, query_incident, system_message, user_prompt_template, model)
+
+def get_count(key):
+    return get_cache().get(key)
+
+def set_count(key, count):
+    # Tagged with the index name so every count for an index can be evicted at once
+    get_cache().set(key, count, expire=CACHE_EXPIRE, tag=key[1])
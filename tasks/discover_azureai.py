@@ -1,130 +1,221 @@
 import os
 import logging
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from openai import AzureOpenAI
-from dotenv import load_dotenv
-import json
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+import orjson
 import datetime
-import time
-from tenacity import retry, stop_after_attempt, wait_exponential
-import ast
+import asyncio
+import hashlib
+from collections import Counter
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type
 import csv
-
-# Load environment variables
-load_dotenv()
-
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import argparse
+from clients import throttle_retry, check_settings, SEARCH_SETTINGS, OPENAI_SETTINGS, get_openai_deployment, create_async_search_client, create_async_openai_client
+from util import setup_logging
 
 # Global variables
 INDEX_NAME = "incident-small"
+OPENAI_API_VERSION = "2024-07-01-preview"
+MAX_CONCURRENCY = 10
+BATCH_POLL_INTERVAL = 60
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+# Incident requests keyed by a hash of the batch content, so identical prompts hit the LLM once
+prompt_cache = {}
+
+wait_jittered = wait_random_exponential(multiplier=1, min=4, max=30)
+
+def wait_retry_after(retry_state):
+    # Honor the Retry-After header on throttled requests; otherwise back off with jitter so
+    # concurrent batches do not retry in lockstep
+    exception = retry_state.outcome.exception()
+    if isinstance(exception, RateLimitError):
+        retry_after = exception.response.headers.get("Retry-After")
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            pass
+    return wait_jittered(retry_state)
 
-# Azure AI Search configuration
-search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
-search_key = os.getenv("AZURE_SEARCH_KEY")
-logging.info(f"Azure Search Endpoint: {search_endpoint}")
-logging.info(f"Azure Search Key: {'*' * len(search_key) if search_key else 'Not found'}")
-
-# Azure OpenAI configuration
-openai_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-openai_key = os.getenv("AZURE_OPENAI_KEY")
-openai_deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-logging.info(f"Azure OpenAI Endpoint: {openai_endpoint}")
-logging.info(f"Azure OpenAI Key: {'*' * len(openai_key) if openai_key else 'Not found'}")
-logging.info(f"Azure OpenAI Deployment: {openai_deployment}")
-
-try:
-    search_credential = AzureKeyCredential(search_key)
-    logging.info("Azure Search credential created successfully")
-except ValueError as e:
-    logging.error(f"Error creating Azure Search credential: {str(e)}")
-    raise
-
-try:
-    # Initialize clients
-    search_client = SearchClient(endpoint=search_endpoint, index_name=INDEX_NAME, credential=search_credential)
-    openai_client = AzureOpenAI(
-        api_key=openai_key,
-        api_version="2023-05-15",
-        azure_endpoint=openai_endpoint
-    )
-    logging.info("Azure clients initialized successfully")
-except Exception as e:
-    logging.error(f"Error initializing Azure clients: {str(e)}")
-    raise
-
-@retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=1, min=4, max=10))
-def make_openai_request(openai_client, system_message, user_message):
-    return openai_client.chat.completions.create(
-        model=openai_deployment,
-        messages=[
+# tenacity detects coroutine functions and waits between attempts with asyncio.sleep
+@retry(
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)),
+    stop=stop_after_attempt(7),
+    wait=wait_retry_after,
+    reraise=True
+)
+async def make_openai_request(openai_client, request_body):
+    return await openai_client.chat.completions.create(**request_body)
+
+@throttle_retry
+async def call_batch_api(method, *args, **kwargs):
+    # The OpenAI client does not retry on its own, and one failed poll would abandon a job that is still running
+    return await method(*args, **kwargs)
+
+def build_request_body(batch_content):
+    # Shared by real-time requests and Batch API input lines
+    system_message = "You are an AI assistant tasked with analyzing incident reports and identifying distinct types of incidents or topics."
+    user_message = f"Based on the following incident reports, identify and list distinct types of incidents or topics. Respond with a JSON object of the form {{\"incidents\": [...]}}, where each string in the list is a distinct incident type or topic.\n\nIncident reports:\n{batch_content}"
+    return {
+        "model": get_openai_deployment(),
+        "messages": [
             {"role": "system", "content": system_message},
             {"role": "user", "content": user_message}
         ],
-        temperature=0.5,
-        max_tokens=200
-    )
+        "temperature": 0.5,
+        "max_tokens": 200,
+        "response_format": {"type": "json_object"}
+    }
 
-def discover_incidents(top_n=50, batch_size=10):
-    logging.info(f"Discovering top {top_n} incident types")
+def parse_incidents(response_content):
+    # JSON mode guarantees a bare JSON object, so no code fences need stripping
+    batch_incidents = orjson.loads(response_content)["incidents"]
+    if not isinstance(batch_incidents, list):
+        raise ValueError("Response is not a list")
+    return batch_incidents
+
+def get_cache_key(batch_content):
+    return hashlib.blake2b(batch_content.encode(), digest_size=16).digest()
+
+async def request_incidents(openai_client, semaphore, batch_number, batch_content):
+    response = None
     try:
-        results = list(search_client.search("*", top=50))
-        logging.info(f"Found {len(results)} documents")
-        
-        if not results:
-            logging.info("No documents found")
-            return []
-        
-        all_incidents = []
+        async with semaphore:
+            response = await make_openai_request(openai_client, build_request_body(batch_content))
         
-        # Process documents in batches
-        for i in range(0, len(results), batch_size):
-            batch = results[i:i+batch_size]
-            batch_content = "\n\n".join([doc['content'] for doc in batch])
-            
-            system_message = "You are an AI assistant tasked with analyzing incident reports and identifying distinct types of incidents or topics."
-            user_message = f"Based on the following incident reports, identify and list distinct types of incidents or topics. Provide your response as a Python list of strings, with each string representing a distinct incident type or topic.\n\nIncident reports:\n{batch_content}"
-            
+        batch_incidents = parse_incidents(response.choices[0].message.content)
+        logging.info(f"Processed batch {batch_number}, found {len(batch_incidents)} incidents")
+        return batch_incidents
+    except Exception as e:
+        logging.error(f"Error processing batch {batch_number}: {str(e)}")
+        logging.error(f"Raw response: {response.choices[0].message.content if response is not None else 'No response'}")
+        return []
+
+async def process_batch(openai_client, semaphore, batch_number, batch):
+    batch_content = "\n\n".join(batch)
+    cache_key = get_cache_key(batch_content)
+    # The request task is cached rather than its result, so a duplicate that arrives while the
+    # first request is still in flight awaits that request instead of sending its own
+    if cache_key in prompt_cache:
+        logging.info(f"Batch {batch_number} matches an earlier prompt, reusing its incidents")
+    else:
+        prompt_cache[cache_key] = asyncio.create_task(request_incidents(openai_client, semaphore, batch_number, batch_content))
+    return await prompt_cache[cache_key]
+
+async def run_batch_job(openai_client, batches):
+    # Submit every prompt as one Batch API job and wait for it; slower to finish but not bound by the real-time rate limit
+    batch_results = [[] for _ in batches]
+    # Identical prompts are submitted once, under the number of the first batch that has them
+    prompt_batches = {}
+    lines = []
+    for batch_number, batch in enumerate(batches, 1):
+        batch_content = "\n\n".join(batch)
+        cache_key = get_cache_key(batch_content)
+        if cache_key in prompt_batches:
+            logging.info(f"Batch {batch_number} matches an earlier prompt, reusing its incidents")
+            prompt_batches[cache_key].append(batch_number)
+            continue
+        prompt_batches[cache_key] = [batch_number]
+        lines.append(orjson.dumps({
+            "custom_id": str(batch_number),
+            "method": "POST",
+            "url": "/chat/completions",
+            "body": build_request_body(batch_content)
+        }))
+    batch_numbers = {str(numbers[0]): numbers for numbers in prompt_batches.values()}
+
+    input_file = await call_batch_api(openai_client.files.create, file=("discover_incidents.jsonl", b"\n".join(lines)), purpose="batch")
+    batch_job = await call_batch_api(openai_client.batches.create, input_file_id=input_file.id, endpoint="/chat/completions", completion_window="24h")
+    logging.info(f"Submitted batch job {batch_job.id} with {len(lines)} prompts")
+
+    while batch_job.status not in BATCH_TERMINAL_STATUSES:
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch_job = await call_batch_api(openai_client.batches.retrieve, batch_job.id)
+        logging.info(f"Batch job {batch_job.id} status: {batch_job.status}")
+
+    if batch_job.status != "completed":
+        logging.error(f"Batch job {batch_job.id} ended with status: {batch_job.status}")
+        return batch_results
+
+    # A completed job writes successful requests to the output file and failed ones only to the error file
+    answered = set()
+    if batch_job.output_file_id:
+        output = await call_batch_api(openai_client.files.content, batch_job.output_file_id)
+        for line in output.text.splitlines():
+            if not line:
+                continue
+            result = orjson.loads(line)
+            batch_number = result["custom_id"]
+            answered.add(batch_number)
             try:
-                response = make_openai_request(openai_client, system_message, user_message)
-                
-                # Extract the Python list from the response
-                response_content = response.choices[0].message.content.strip()
-                # Remove markdown code block formatting if present
-                if response_content.startswith("```python"):
-                    response_content = response_content.split("\n", 1)[1].rsplit("\n", 1)[0]
-                elif response_content.startswith("```"):
-                    response_content = response_content.split("\n", 1)[1].rsplit("\n", 1)[0]
-                
-                # Clean up the response content
-                response_content = response_content.strip()
-                response_content = response_content.replace('\n', '').replace('    ', '')
-                
-                # Safely evaluate the string as a Python expression
-                batch_incidents = ast.literal_eval(response_content)
-                
-                if not isinstance(batch_incidents, list):
-                    raise ValueError("Response is not a list")
-                all_incidents.extend(batch_incidents)
-                logging.info(f"Processed batch {i//batch_size + 1}, found {len(batch_incidents)} incidents")
+                if result.get("error"):
+                    raise ValueError(result["error"])
+                batch_incidents = parse_incidents(result["response"]["body"]["choices"][0]["message"]["content"])
+                for shared_batch_number in batch_numbers[batch_number]:
+                    batch_results[shared_batch_number - 1] = batch_incidents
+                logging.info(f"Processed batch {batch_number}, found {len(batch_incidents)} incidents")
             except Exception as e:
-                logging.error(f"Error processing batch: {str(e)}")
-                logging.error(f"Raw response: {response.choices[0].message.content if 'response' in locals() else 'No response'}")
+                logging.error(f"Error processing batch {batch_number}: {str(e)}")
+    if batch_job.error_file_id:
+        errors = await call_batch_api(openai_client.files.content, batch_job.error_file_id)
+        for line in errors.text.splitlines():
+            if not line:
                 continue
+            result = orjson.loads(line)
+            answered.add(result["custom_id"])
+            error = result.get("error") or (result.get("response") or {}).get("body")
+            logging.error(f"Error processing batch {result['custom_id']}: {error}")
+    for batch_number in batch_numbers:
+        if batch_number not in answered:
+            logging.error(f"Batch {batch_number} has no result in batch job {batch_job.id}")
+    return batch_results
+
+async def discover_incidents(top_n=50, batch_size=10, use_batch_api=False):
+    logging.info(f"Discovering top {top_n} incident types")
+    try:
+        # Send every batch as soon as it fills, at most MAX_CONCURRENCY requests in flight to stay under the rate limit
+        semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        async with create_async_search_client(INDEX_NAME) as async_search_client, \
+                create_async_openai_client(OPENAI_API_VERSION) as openai_client:
+            # Stream the results so the first LLM call starts while later pages are still being fetched.
+            # With the Batch API the batches are only collected here and submitted together below.
+            batches = []
+            tasks = []
+            batch = []
+            document_count = 0
+            async for doc in await async_search_client.search("*", top=50, select=["content"]):
+                batch.append(doc['content'])
+                document_count += 1
+                if len(batch) == batch_size:
+                    batches.append(batch)
+                    if not use_batch_api:
+                        tasks.append(asyncio.create_task(process_batch(openai_client, semaphore, len(batches), batch)))
+                    batch = []
+            if batch:
+                batches.append(batch)
+                if not use_batch_api:
+                    tasks.append(asyncio.create_task(process_batch(openai_client, semaphore, len(batches), batch)))
+            logging.info(f"Found {document_count} documents")
+            
+            if not batches:
+                logging.info("No documents found")
+                return []
             
-            # Add a delay between batches to avoid rate limiting
-            time.sleep(2)
+            if use_batch_api:
+                batch_results = await run_batch_job(openai_client, batches)
+            else:
+                batch_results = await asyncio.gather(*tasks, return_exceptions=True)
         
-        logging.info(f"Discovered a total of {len(all_incidents)} incident types")
+        all_incidents = []
+        for batch_incidents in batch_results:
+            if isinstance(batch_incidents, Exception):
+                logging.error(f"Error processing batch: {str(batch_incidents)}")
+                continue
+            all_incidents.extend(batch_incidents)
         
-        # Count occurrences of each incident type
-        incident_counts = {}
-        for incident in all_incidents:
-            incident_counts[incident] = incident_counts.get(incident, 0) + 1
+        logging.info(f"Discovered a total of {len(all_incidents)} incident types")
         
-        # Get top N incident types
-        top_incidents = sorted(incident_counts.items(), key=lambda x: x[1], reverse=True)[:top_n]
+        # Count occurrences of each incident type and get the top N
+        top_incidents = Counter(all_incidents).most_common(top_n)
         
         logging.info(f"Top {top_n} incident types discovered")
         return top_incidents
@@ -140,8 +231,8 @@ def write_top_incidents_to_files(top_incidents):
         
         # Write JSON file
         json_filename = f'reports/incidents_discovered_{timestamp}.json'
-        with open(json_filename, 'w') as f:
-            json.dump(top_incidents, f, indent=2)
+        with open(json_filename, 'wb') as f:
+            f.write(orjson.dumps(top_incidents, option=orjson.OPT_INDENT_2))
         logging.info(f"Successfully wrote top incidents to {json_filename}")
         
         # Write CSV file
@@ -158,9 +249,16 @@ def write_top_incidents_to_files(top_incidents):
 def main():
     logging.info("Starting the discovery process")
     
+    parser = argparse.ArgumentParser(description="Discover incident types using Azure OpenAI.")
+    parser.add_argument("--batch", action="store_true", help="Submit the prompts as an Azure OpenAI Batch API job instead of real-time requests")
+    args = parser.parse_args()
+
+    if not check_settings(*SEARCH_SETTINGS, *OPENAI_SETTINGS):
+        return
+
     try:
         # Discover top 50 incident types
-        top_incidents = discover_incidents(top_n=50)
+        top_incidents = asyncio.run(discover_incidents(top_n=50, use_batch_api=args.batch))
 
         if not top_incidents:
             logging.warning("No incidents were discovered.")
@@ -181,4 +279,5 @@ def main():
         print("An error occurred. Please check the logs for details.")
 
 if __name__ == "__main__":
+    setup_logging()
     main()
@@ -1,80 +1,67 @@
 import os
 import logging
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.ai.textanalytics import TextAnalyticsClient
-from dotenv import load_dotenv
-import base64
 from collections import Counter
-import json
-
-# Load environment variables
-load_dotenv()
-
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import orjson
+import asyncio
+from clients import throttle_retry, check_settings, SEARCH_SETTINGS, TEXT_ANALYTICS_SETTINGS, shared_async_transport, create_async_search_client, create_async_text_analytics_client
+from util import setup_logging
 
 # Global variables
 INDEX_NAME = "incident-small"
+MAX_CONCURRENCY = 8
 
-# Azure AI Search configuration
-search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
-search_key = os.getenv("AZURE_SEARCH_KEY")
-logging.info(f"Azure Search Endpoint: {search_endpoint}")
-logging.info(f"Azure Search Key: {'*' * len(search_key) if search_key else 'Not found'}")
-
-# Azure Text Analytics configuration
-text_analytics_endpoint = os.getenv("AZURE_TEXT_ANALYTICS_ENDPOINT")
-text_analytics_key = os.getenv("AZURE_TEXT_ANALYTICS_KEY")
-logging.info(f"Azure Text Analytics Endpoint: {text_analytics_endpoint}")
-logging.info(f"Azure Text Analytics Key: {'*' * len(text_analytics_key) if text_analytics_key else 'Not found'}")
+@throttle_retry
+async def request_key_phrases(async_text_analytics_client, batch_content):
+    return await async_text_analytics_client.extract_key_phrases(batch_content)
 
-try:
-    search_credential = AzureKeyCredential(search_key)
-    text_analytics_credential = AzureKeyCredential(text_analytics_key)
-    logging.info("Azure credentials created successfully")
-except ValueError as e:
-    logging.error(f"Error creating Azure credentials: {str(e)}")
-    raise
-
-try:
-    # Initialize clients
-    search_client = SearchClient(endpoint=search_endpoint, index_name=INDEX_NAME, credential=search_credential)
-    text_analytics_client = TextAnalyticsClient(endpoint=text_analytics_endpoint, credential=text_analytics_credential)
-    logging.info("Azure clients initialized successfully")
-except Exception as e:
-    logging.error(f"Error initializing Azure clients: {str(e)}")
-    raise
+async def extract_batch_key_phrases(async_text_analytics_client, semaphore, batch_content):
+    # The slot is held through the retries, so a throttled batch backs off without letting another one start
+    async with semaphore:
+        key_phrases_response = await request_key_phrases(async_text_analytics_client, batch_content)
+    
+    batch_counts = Counter()
+    for doc_key_phrases in key_phrases_response:
+        if doc_key_phrases.is_error:
+            logging.warning(f"Error in key phrase extraction: {doc_key_phrases.error}")
+        else:
+            batch_counts.update(phrase.lower() for phrase in doc_key_phrases.key_phrases)
+    return batch_counts
 
-def find_top_incidents(top_n=20, batch_size=10):
+async def find_top_incidents(top_n=20, batch_size=10):
     logging.info(f"Finding top {top_n} incident types")
     try:
-        results = list(search_client.search("*", top=1000))
-        logging.info(f"Found {len(results)} documents")
-        
-        if not results:
-            logging.info("No documents found")
-            return []
-        
-        all_key_phrases = []
-        
-        # Process documents in batches of 10
-        for i in range(0, len(results), batch_size):
-            batch = results[i:i+batch_size]
-            batch_content = [doc['content'] for doc in batch]
+        # Send the batches of 10 concurrently, at most MAX_CONCURRENCY in flight to stay under the quota
+        semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        # Both clients share one aiohttp session, so connections are pooled across them
+        async with shared_async_transport() as transport, \
+                create_async_search_client(INDEX_NAME, transport) as async_search_client, \
+                create_async_text_analytics_client(transport) as async_text_analytics_client:
+            # Page through every document, fetching only its content, and dispatch each batch as soon as it fills
+            tasks = []
+            batch_content = []
+            document_count = 0
+            async for doc in await async_search_client.search("*", select=["content"]):
+                batch_content.append(doc['content'])
+                document_count += 1
+                if len(batch_content) == batch_size:
+                    tasks.append(asyncio.create_task(extract_batch_key_phrases(async_text_analytics_client, semaphore, batch_content)))
+                    batch_content = []
+            if batch_content:
+                tasks.append(asyncio.create_task(extract_batch_key_phrases(async_text_analytics_client, semaphore, batch_content)))
+            logging.info(f"Found {document_count} documents")
             
-            key_phrases_response = text_analytics_client.extract_key_phrases(batch_content)
+            if not tasks:
+                logging.info("No documents found")
+                return []
             
-            for doc_key_phrases in key_phrases_response:
-                if doc_key_phrases.is_error:
-                    logging.warning(f"Error in key phrase extraction: {doc_key_phrases.error}")
-                else:
-                    all_key_phrases.extend(doc_key_phrases.key_phrases)
+            batch_counts = await asyncio.gather(*tasks)
         
-        logging.info(f"Extracted a total of {len(all_key_phrases)} key phrases")
+        # Merge the per-batch counts of each key phrase
+        phrase_counts = Counter()
+        for counts in batch_counts:
+            phrase_counts.update(counts)
         
-        # Count occurrences of each key phrase
-        phrase_counts = Counter(phrase.lower() for phrase in all_key_phrases)
+        logging.info(f"Extracted a total of {sum(phrase_counts.values())} key phrases")
         
         # Get top N incident types
         top_incidents = phrase_counts.most_common(top_n)
@@ -89,8 +76,8 @@ def write_top_incidents_to_json(top_incidents):
     logging.info("Writing top incidents to JSON file")
     try:
         os.makedirs('reports', exist_ok=True)
-        with open('reports/terms_discovered.json', 'w') as f:
-            json.dump(top_incidents, f, indent=2)
+        with open('reports/terms_discovered.json', 'wb') as f:
+            f.write(orjson.dumps(top_incidents, option=orjson.OPT_INDENT_2))
         logging.info("Successfully wrote top incidents to reports/terms_discovered.json")
     except Exception as e:
         logging.error(f"Error writing top incidents to JSON: {str(e)}")
@@ -98,9 +85,12 @@ def write_top_incidents_to_json(top_incidents):
 def main():
     logging.info("Starting the analysis process")
     
+    if not check_settings(*SEARCH_SETTINGS, *TEXT_ANALYTICS_SETTINGS):
+        return
+
     try:
         # Find top 20 incident types
-        top_incidents = find_top_incidents(top_n=20)
+        top_incidents = asyncio.run(find_top_incidents(top_n=20))
 
         # Write top incident types to JSON file
         write_top_incidents_to_json(top_incidents)
@@ -116,4 +106,5 @@ def main():
         print("An error occurred. Please check the logs for details.")
 
 if __name__ == "__main__":
+    setup_logging()
     main()
\ No newline at end of file
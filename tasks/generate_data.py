@@ -1,18 +1,16 @@
 import os
-import json
+import orjson
 import logging
 from collections import Counter
+from functools import lru_cache
 from openai import OpenAI
 from dotenv import load_dotenv
+from util import setup_logging
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Initialize OpenAI client with API key from environment variable
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+@lru_cache(maxsize=None)
+def get_client():
+    # Initialize OpenAI client with API key from environment variable on first use
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 MODEL_NAME = "gpt-4o"
 # Directory to store files
@@ -25,7 +23,7 @@ os.makedirs(output_dir, exist_ok=True)
 def generate_synthetic_document(incident_type):
     prompt = f"Generate a 2-sentence incident report for a {incident_type} in a manufacturing plant. The first sentence should describe the incident, and the second sentence should mention potential consequences."
     
-    response = client.chat.completions.create(
+    response = get_client().chat.completions.create(
         model=MODEL_NAME,
         messages=[
             {"role": "system", "content": "You are an AI assistant that generates concise incident reports for manufacturing plants."},
@@ -67,14 +65,17 @@ def generate_documents(incident_types, output_dir, num_documents):
 
 # Main function
 def main():
+    # Load environment variables from .env file
+    load_dotenv()
+
     if not os.getenv("OPENAI_API_KEY"):
         logging.error("OPENAI_API_KEY not found in environment variables.")
         logging.error("Please make sure you have a .env file with your OpenAI API key.")
         return
 
     # Load incident type distribution
-    with open(os.path.join(config_dir, "incident_type_distribution.json"), 'r') as f:
-        incident_types = json.load(f)
+    with open(os.path.join(config_dir, "incident_type_distribution.json"), 'rb') as f:
+        incident_types = orjson.loads(f.read())
 
     # Number of documents to generate
     
@@ -88,4 +89,5 @@ def main():
         logging.info(f"  {incident_type}: {percentage}%")
 
 if __name__ == "__main__":
+    setup_logging()
     main()
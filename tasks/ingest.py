@@ -0,0 +1,116 @@
+import os
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
+from util import encode_filename
+from clients import throttle_retry, get_search_client, create_buffered_sender
+
+READ_WORKERS = 32
+UPLOAD_BATCH_SIZE = 1000
+UPLOAD_MAX_RETRIES = 6
+COUNT_POLL_ATTEMPTS = 8
+
+def read_document(entry):
+    file_path = entry.path
+    filename = entry.name
+    # Per-file messages use lazy %-formatting so nothing is formatted when INFO is disabled
+    logging.info("Reading file: %s", file_path)
+    try:
+        with open(file_path, 'r') as file:
+            content = file.read().strip()
+        encoded_filename = encode_filename(filename)
+        logging.info("Successfully read file: %s (encoded as: %s)", filename, encoded_filename)
+        return {
+            "id": encoded_filename,
+            "content": content
+        }
+    except IOError as e:
+        logging.error("Error reading file %s: %s", filename, e)
+        return None
+
+def read_documents(input_folder):
+    # scandir returns DirEntry objects with cached type information, avoiding an extra stat per file
+    with os.scandir(input_folder) as it:
+        entries = [entry for entry in it if entry.is_file() and entry.name.endswith('.txt')]
+    # Largest files first, so the buffered sender fills its batches evenly and the tail is made of small documents
+    entries.sort(key=lambda entry: entry.stat().st_size, reverse=True)
+    entries = iter(entries)
+    # File reads are I/O bound, so threads overlap them with whatever consumes the documents.
+    # Only READ_WORKERS reads are kept in flight so memory stays bounded by a handful of files.
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        pending = deque(executor.submit(read_document, entry) for entry in islice(entries, READ_WORKERS))
+        while pending:
+            document = pending.popleft().result()
+            next_entry = next(entries, None)
+            if next_entry is not None:
+                pending.append(executor.submit(read_document, next_entry))
+            if document is not None:
+                yield document
+
+@throttle_retry
+def get_document_count(index_name, api_version=None):
+    return get_search_client(index_name, api_version).get_document_count()
+
+def wait_for_document_count(index_name, expected, api_version=None):
+    # Poll the document count with exponential backoff until every queued document is visible
+    delay = 0.5
+    for i in range(COUNT_POLL_ATTEMPTS):
+        total_docs = get_document_count(index_name, api_version)
+        logging.info(f"Attempt {i+1}: Total documents in index after indexing: {total_docs}")
+        if total_docs >= expected or i == COUNT_POLL_ATTEMPTS - 1:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 8)
+
+    if total_docs == 0:
+        logging.error("No documents found in the index after multiple attempts.")
+    elif total_docs < expected:
+        logging.warning(f"Only {total_docs} of {expected} documents are visible in the index so far.")
+    return total_docs
+
+def read_and_index_documents(input_folder, index_name, api_version=None, wait_until_visible=False):
+    # Yields each document as soon as it is queued for upload so callers can process it while indexing continues.
+    # With wait_until_visible, the generator finishes only once the indexed documents can be queried.
+    logging.info(f"Reading and indexing documents from {input_folder}")
+    indexing_counts = {"succeeded": 0, "failed": 0}
+
+    def on_progress(action):
+        indexing_counts["succeeded"] += 1
+
+    def on_error(action):
+        indexing_counts["failed"] += 1
+        logging.error("Document %s failed to index", action.additional_properties.get('id'))
+
+    try:
+        queued = 0
+        # The buffered sender batches uploads as documents are read, halving the batch size on oversized
+        # payloads and retrying throttled (503) batches with exponential backoff
+        with create_buffered_sender(
+            index_name,
+            api_version,
+            auto_flush_interval=5,
+            initial_batch_action_count=UPLOAD_BATCH_SIZE,
+            max_retries_per_action=UPLOAD_MAX_RETRIES,
+            on_progress=on_progress,
+            on_error=on_error
+        ) as sender:
+            for document in read_documents(input_folder):
+                sender.upload_documents([document])
+                queued += 1
+                yield document
+            logging.info(f"Queued {queued} documents for indexing")
+
+        succeeded = indexing_counts["succeeded"]
+        failed = indexing_counts["failed"]
+        logging.info(f"Indexing complete. Succeeded: {succeeded}, Failed: {failed}")
+        if failed > 0:
+            logging.warning(f"Some documents failed to index. Check individual results for details.")
+
+        if wait_until_visible:
+            # Documents that failed to index will never become visible, so they are not waited for
+            wait_for_document_count(index_name, queued - failed, api_version)
+    except Exception as e:
+        logging.error(f"Error in read_and_index_documents: {str(e)}")
+        raise
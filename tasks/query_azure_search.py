@@ -1,77 +1,87 @@
-import os
 import logging
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.ai.textanalytics import TextAnalyticsClient
-from dotenv import load_dotenv
 import argparse
-
-# Load environment variables
-load_dotenv()
-
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import re
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from rank_bm25 import BM25Okapi
+from clients import throttle_retry, check_settings, SEARCH_SETTINGS, TEXT_ANALYTICS_SETTINGS, get_search_client, get_text_analytics_client
+from util import setup_logging, CONTENT_COUNT_THRESHOLD
+from ingest import read_documents
 
 # Global variables
+DATA_DIR = "data/small"
 INDEX_NAME = "incident-small"
+SEARCH_TOP = 1000
+# Text Analytics accepts up to 10 documents per request and analyzes at most 5120 characters of each
+TEXT_ANALYTICS_BATCH_SIZE = 10
+TEXT_ANALYTICS_MAX_CHARS = 5120
+TEXT_ANALYTICS_WORKERS = 5
 
-# Azure AI Search configuration
-search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
-search_key = os.getenv("AZURE_SEARCH_KEY")
-logging.info(f"Azure Search Endpoint: {search_endpoint}")
-logging.info(f"Azure Search Key: {'*' * len(search_key) if search_key else 'Not found'}")
+@lru_cache(maxsize=256)
+def get_query_pattern(query_incident):
+    # Anchored at a word start, so "fall" does not match inside "football" but "slip" matches "slipped".
+    # Case-insensitive, so no lowercased copy of the content is needed.
+    return re.compile(rf"\b{re.escape(query_incident)}", re.IGNORECASE)
 
-# Azure Text Analytics configuration
-text_analytics_endpoint = os.getenv("AZURE_TEXT_ANALYTICS_ENDPOINT")
-text_analytics_key = os.getenv("AZURE_TEXT_ANALYTICS_KEY")
-logging.info(f"Azure Text Analytics Endpoint: {text_analytics_endpoint}")
-logging.info(f"Azure Text Analytics Key: {'*' * len(text_analytics_key) if text_analytics_key else 'Not found'}")
+@throttle_retry
+def search_contents(query_incident):
+    # Search for relevant documents, paging through every hit up to SEARCH_TOP
+    results = get_search_client(INDEX_NAME).search(query_incident, top=SEARCH_TOP, select=["content"], search_fields=["content"])
+    return [doc['content'] for doc in results]
 
-try:
-    search_credential = AzureKeyCredential(search_key)
-    text_analytics_credential = AzureKeyCredential(text_analytics_key)
-    logging.info("Azure credentials created successfully")
-except ValueError as e:
-    logging.error(f"Error creating Azure credentials: {str(e)}")
-    raise
+@throttle_retry
+def extract_batch_key_phrases(batch):
+    key_phrases = []
+    for doc_key_phrases in get_text_analytics_client().extract_key_phrases(batch):
+        if doc_key_phrases.is_error:
+            logging.warning("Error in key phrase extraction: %s", doc_key_phrases.error)
+        else:
+            key_phrases.extend(doc_key_phrases.key_phrases)
+    return key_phrases
 
-try:
-    # Initialize clients
-    search_client = SearchClient(endpoint=search_endpoint, index_name=INDEX_NAME, credential=search_credential)
-    text_analytics_client = TextAnalyticsClient(endpoint=text_analytics_endpoint, credential=text_analytics_credential)
-    logging.info("Azure clients initialized successfully")
-except Exception as e:
-    logging.error(f"Error initializing Azure clients: {str(e)}")
-    raise
+def extract_key_phrases(contents):
+    # Each document is sent on its own, so none is truncated, and the batches run concurrently
+    documents = [content[:TEXT_ANALYTICS_MAX_CHARS] for content in contents]
+    batches = [documents[i:i+TEXT_ANALYTICS_BATCH_SIZE] for i in range(0, len(documents), TEXT_ANALYTICS_BATCH_SIZE)]
+    key_phrases = []
+    with ThreadPoolExecutor(max_workers=TEXT_ANALYTICS_WORKERS) as executor:
+        for batch_key_phrases in executor.map(extract_batch_key_phrases, batches):
+            key_phrases.extend(batch_key_phrases)
+    return key_phrases
 
 def count_incidents(query_incident):
     logging.info(f"Counting incidents for query: '{query_incident}'")
     try:
-        # Search for relevant documents, increase top to 50
-        results = list(search_client.search(query_incident, top=50))
-        logging.info(f"Found {len(results)} relevant documents")
+        contents = search_contents(query_incident)
+        logging.info(f"Found {len(contents)} relevant documents")
         
-        if not results:
+        if not contents:
             logging.info(f"No documents found for query: '{query_incident}'")
             return 0
         
-        # Combine relevant documents
-        combined_content = "\n\n".join([doc['content'] for doc in results])
-        logging.info(f"Combined content length: {len(combined_content)} characters")
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("Combined content length: %d characters", sum(len(content) for content in contents))
+        
+        # Count occurrences of query_incident in the content first; it is cheap and usually the larger count.
+        query_pattern = get_query_pattern(query_incident)
+        content_count = sum(len(query_pattern.findall(content)) for content in contents)
+        if content_count >= CONTENT_COUNT_THRESHOLD:
+            logging.info(f"Incident count for '{query_incident}': {content_count} (content count, key phrases skipped)")
+            return content_count
         
         # Use Azure Text Analytics to extract key phrases
-        key_phrases_response = text_analytics_client.extract_key_phrases([combined_content])
+        key_phrases = extract_key_phrases(contents)
         
-        if not key_phrases_response or not key_phrases_response[0].key_phrases:
+        if not key_phrases:
             logging.info(f"No key phrases extracted for query: '{query_incident}'")
             return 0
         
-        key_phrases = key_phrases_response[0].key_phrases
         logging.info(f"Extracted {len(key_phrases)} key phrases")
         
-        # Count occurrences of query_incident in key phrases and content
-        phrase_count = sum(1 for phrase in key_phrases if query_incident.lower() in phrase.lower())
-        content_count = combined_content.lower().count(query_incident.lower())
+        # Count occurrences of query_incident in key phrases, lowercasing the query once
+        query_lower = query_incident.lower()
+        phrase_count = sum(1 for phrase in key_phrases if query_lower in phrase.lower())
         
         # Take the maximum of the two counts
         count = max(phrase_count, content_count)
@@ -82,20 +92,60 @@ def count_incidents(query_incident):
         logging.error(f"Error in count_incidents: {str(e)}")
         return 0  # Return 0 instead of raising an exception
 
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+def build_local_index(input_folder):
+    # In-memory BM25 index over the local corpus, standing in for Azure Search on small data sets
+    contents = [document["content"] for document in read_documents(input_folder)]
+    tokenized = [tokenize(content) for content in contents]
+    logging.info(f"Built local BM25 index over {len(contents)} documents from {input_folder}")
+    return contents, [set(tokens) for tokens in tokenized], BM25Okapi(tokenized)
+
+def count_incidents_local(local_index, query_incident):
+    logging.info(f"Counting incidents locally for query: '{query_incident}'")
+    contents, token_sets, bm25 = local_index
+    if not contents:
+        logging.info(f"No documents found for query: '{query_incident}'")
+        return 0
+    
+    # Rank like the search service would, keeping up to SEARCH_TOP documents that contain any query term.
+    # Matches are chosen by term presence, not a positive score: BM25Okapi gives zero or negative idf to
+    # terms found in half the documents or more, e.g. every term of a one-document corpus.
+    query_tokens = tokenize(query_incident)
+    scores = bm25.get_scores(query_tokens)
+    matching_indices = [i for i, tokens in enumerate(token_sets) if not tokens.isdisjoint(query_tokens)]
+    top_indices = heapq.nlargest(SEARCH_TOP, matching_indices, key=scores.__getitem__)
+    logging.info(f"Found {len(top_indices)} relevant documents")
+    
+    # Count occurrences of query_incident that start at a word boundary in the ranked documents
+    query_pattern = get_query_pattern(query_incident)
+    count = sum(len(query_pattern.findall(contents[i])) for i in top_indices)
+    
+    logging.info(f"Incident count for '{query_incident}': {count} (local content count)")
+    return count
+
 def main():
     logging.info("Starting the analysis process")
     
     parser = argparse.ArgumentParser(description="Analyze incident reports using Azure AI services.")
     parser.add_argument("incident_type", type=str, help="The type of incident to query for (use quotes for composite terms)")
+    parser.add_argument("--local", action="store_true", help=f"Count from an in-memory BM25 index over {DATA_DIR} instead of calling Azure")
     args = parser.parse_args()
 
+    if not args.local and not check_settings(*SEARCH_SETTINGS, *TEXT_ANALYTICS_SETTINGS):
+        return
+
     try:
         # Set the query incident from command line argument
         query_incident = args.incident_type
         logging.info(f"Query incident set to: '{query_incident}'")
 
         # Count incidents
-        total_count = count_incidents(query_incident)
+        if args.local:
+            total_count = count_incidents_local(build_local_index(DATA_DIR), query_incident)
+        else:
+            total_count = count_incidents(query_incident)
 
         # Print total count
         logging.info(f"Analysis complete. Total count for '{query_incident}' incidents: {total_count}")
@@ -105,4 +155,5 @@ def main():
         print(f"An error occurred. Please check the logs for details.")
 
 if __name__ == "__main__":
+    setup_logging()
     main()
\ No newline at end of file
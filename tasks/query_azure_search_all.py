@@ -1,151 +1,141 @@
 import os
 import logging
-import json
+import orjson
 import csv
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.search.documents.indexes import SearchIndexClient
-from azure.ai.textanalytics import TextAnalyticsClient
-from dotenv import load_dotenv
-import base64
 import argparse
+import asyncio
 from datetime import datetime
-
-# Load environment variables
-load_dotenv()
-
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from collections import Counter
+import ahocorasick
+from clients import throttle_retry, check_settings, SEARCH_SETTINGS, TEXT_ANALYTICS_SETTINGS, create_async_text_analytics_client, shared_async_transport
+from util import setup_logging, CONTENT_COUNT_THRESHOLD
+from ingest import read_documents, read_and_index_documents
 
 # Global variables
 DATA_DIR = "data/small"
 INDEX_NAME = "incident-small"
+MAX_MATCHED_DOCUMENTS = 50
+TEXT_ANALYTICS_BATCH_SIZE = 10
+MAX_CONCURRENCY = 20
 CONFIG_FILE = "config/incident_type_distribution.json"
 
-# Azure AI Search configuration
-search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
-search_key = os.getenv("AZURE_SEARCH_KEY")
-logging.info(f"Azure Search Endpoint: {search_endpoint}")
-logging.info(f"Azure Search Key: {'*' * len(search_key) if search_key else 'Not found'}")
-
-# Azure Text Analytics configuration
-text_analytics_endpoint = os.getenv("AZURE_TEXT_ANALYTICS_ENDPOINT")
-text_analytics_key = os.getenv("AZURE_TEXT_ANALYTICS_KEY")
-logging.info(f"Azure Text Analytics Endpoint: {text_analytics_endpoint}")
-logging.info(f"Azure Text Analytics Key: {'*' * len(text_analytics_key) if text_analytics_key else 'Not found'}")
-
-try:
-    search_credential = AzureKeyCredential(search_key)
-    text_analytics_credential = AzureKeyCredential(text_analytics_key)
-    logging.info("Azure credentials created successfully")
-except ValueError as e:
-    logging.error(f"Error creating Azure credentials: {str(e)}")
-    raise
-
-try:
-    # Initialize clients
-    search_client = SearchClient(endpoint=search_endpoint, index_name=INDEX_NAME, credential=search_credential)
-    text_analytics_client = TextAnalyticsClient(endpoint=text_analytics_endpoint, credential=text_analytics_credential)
-    logging.info("Azure clients initialized successfully")
-except Exception as e:
-    logging.error(f"Error initializing Azure clients: {str(e)}")
-    raise
-
-def encode_filename(filename):
-    # Remove the .txt extension, encode to bytes, then to base64, and decode to string
-    return base64.urlsafe_b64encode(filename[:-4].encode()).decode()
-
-def read_and_index_documents(input_folder):
-    logging.info(f"Reading and indexing documents from {input_folder}")
-    documents = []
-    try:
-        for filename in os.listdir(input_folder):
-            if filename.endswith('.txt'):
-                file_path = os.path.join(input_folder, filename)
-                logging.info(f"Reading file: {file_path}")
-                try:
-                    with open(file_path, 'r') as file:
-                        content = file.read().strip()
-                        encoded_filename = encode_filename(filename)
-                        documents.append({
-                            "id": encoded_filename,
-                            "content": content
-                        })
-                    logging.info(f"Successfully read file: {filename} (encoded as: {encoded_filename})")
-                except IOError as e:
-                    logging.error(f"Error reading file {filename}: {str(e)}")
-        
-        logging.info(f"Attempting to index {len(documents)} documents")
-        result = search_client.upload_documents(documents)
-        succeeded = sum(1 for r in result if r.succeeded)
-        failed = sum(1 for r in result if not r.succeeded)
-        logging.info(f"Indexing complete. Succeeded: {succeeded}, Failed: {failed}")
-        if failed > 0:
-            logging.warning(f"Some documents failed to index. Check individual results for details.")
-            for r in result:
-                if not r.succeeded:
-                    logging.error(f"Document {r.key} failed to index. Error: {r.error}")
-        
-        # Add this check to verify documents were indexed
-        total_docs = search_client.get_document_count()
-        logging.info(f"Total documents in index after indexing: {total_docs}")
-    except Exception as e:
-        logging.error(f"Error in read_and_index_documents: {str(e)}")
-        raise
+@throttle_retry
+async def request_key_phrases(async_text_analytics_client, batch):
+    return await async_text_analytics_client.extract_key_phrases(batch)
 
-def count_incidents(query_incident):
-    logging.info(f"Counting incidents for query: '{query_incident}'")
+async def extract_batch_key_phrases(async_text_analytics_client, semaphore, batch):
     try:
-        # Search for relevant documents, increase top to 50
-        results = list(search_client.search(query_incident, top=50))
-        logging.info(f"Found {len(results)} relevant documents")
-        
-        if not results:
-            logging.info(f"No documents found for query: '{query_incident}'")
-            return 0
-        
-        # Combine relevant documents
-        combined_content = "\n\n".join([doc['content'] for doc in results])
-        logging.info(f"Combined content length: {len(combined_content)} characters")
-        
-        # Use Azure Text Analytics to extract key phrases
-        key_phrases_response = text_analytics_client.extract_key_phrases([combined_content])
-        
-        if not key_phrases_response or not key_phrases_response[0].key_phrases:
-            logging.info(f"No key phrases extracted for query: '{query_incident}'")
-            return 0
-        
-        key_phrases = key_phrases_response[0].key_phrases
-        logging.info(f"Extracted {len(key_phrases)} key phrases")
-        
-        # Count occurrences of query_incident in key phrases and content
-        phrase_count = sum(1 for phrase in key_phrases if query_incident.lower() in phrase.lower())
-        content_count = combined_content.lower().count(query_incident.lower())
-        
-        # Take the maximum of the two counts
-        count = max(phrase_count, content_count)
-        
-        logging.info(f"Incident count for '{query_incident}': {count} (phrase count: {phrase_count}, content count: {content_count})")
-        return count
+        # The slot is held through the retries, so a throttled batch backs off without letting another one start
+        async with semaphore:
+            key_phrases_response = await request_key_phrases(async_text_analytics_client, batch)
     except Exception as e:
-        logging.error(f"Error in count_incidents: {str(e)}")
-        return 0  # Return 0 instead of raising an exception
+        logging.error(f"Error in extract_key_phrases: {str(e)}")
+        return [[] for _ in batch]
+
+    key_phrases = []
+    for doc_key_phrases in key_phrases_response:
+        if doc_key_phrases.is_error:
+            logging.warning("Error in key phrase extraction: %s", doc_key_phrases.error)
+            key_phrases.append([])
+        else:
+            key_phrases.append(doc_key_phrases.key_phrases)
+    return key_phrases
+
+async def extract_key_phrases(async_text_analytics_client, contents, max_concurrency=MAX_CONCURRENCY):
+    # Text Analytics accepts up to TEXT_ANALYTICS_BATCH_SIZE documents per request.
+    # The batches are sent concurrently, at most max_concurrency in flight; gather keeps them in order.
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = [
+        extract_batch_key_phrases(async_text_analytics_client, semaphore, contents[i:i+TEXT_ANALYTICS_BATCH_SIZE])
+        for i in range(0, len(contents), TEXT_ANALYTICS_BATCH_SIZE)
+    ]
+    key_phrases = []
+    for batch_key_phrases in await asyncio.gather(*tasks):
+        key_phrases.extend(batch_key_phrases)
+    return key_phrases
+
+def build_incident_automaton(terms):
+    # One Aho-Corasick automaton matches every incident type in a single pass over a text
+    automaton = ahocorasick.Automaton()
+    for term in terms:
+        automaton.add_word(term, term)
+    automaton.make_automaton()
+    return automaton
+
+def count_terms(automaton, text_lower):
+    # Matches must start at a word boundary, so "fall" is not counted inside "football",
+    # but may run on into a suffix, so "slip" still counts "slipped"
+    term_counts = Counter()
+    for end_index, term in automaton.iter(text_lower):
+        start_index = end_index - len(term) + 1
+        if start_index > 0 and text_lower[start_index - 1].isalnum():
+            continue
+        term_counts[term] += 1
+    return term_counts
+
+def count_incidents(query_incident, query_lower, content_count, key_phrases):
+    if not key_phrases:
+        logging.info(f"No key phrases extracted for query: '{query_incident}'")
+        return 0
+    
+    logging.info(f"Extracted {len(key_phrases)} key phrases for query: '{query_incident}'")
+    
+    # Count occurrences of query_incident in key phrases
+    phrase_count = sum(1 for phrase in key_phrases if query_lower in phrase.lower())
+    
+    # Take the maximum of the two counts
+    count = max(phrase_count, content_count)
+    
+    logging.info(f"Incident count for '{query_incident}': {count} (phrase count: {phrase_count}, content count: {content_count})")
+    return count
+
+async def count_all_incidents(incident_types, documents, max_concurrency=MAX_CONCURRENCY):
+    # Scan the local corpus once for all incident types instead of searching once per type.
+    # Documents are consumed one at a time; only up to MAX_MATCHED_DOCUMENTS contents per type are kept.
+    terms = {incident_type: term for incident_type, (_, term) in incident_types.items()}
+    automaton = build_incident_automaton(terms.values())
+    content_counts = Counter()
+    matched_contents = {term: [] for term in terms.values()}
+    for document in documents:
+        # Each streamed document is lowercased exactly once
+        term_counts = count_terms(automaton, document["content"].lower())
+        content_counts.update(term_counts)
+        for term in term_counts:
+            if len(matched_contents[term]) < MAX_MATCHED_DOCUMENTS:
+                matched_contents[term].append(document["content"])
+
+    counts = dict.fromkeys(terms, 0)
+    found = []
+    for incident_type, term in terms.items():
+        contents = matched_contents[term]
+        if not contents:
+            logging.info(f"No documents found for query: '{incident_type}'")
+        elif content_counts[term] >= CONTENT_COUNT_THRESHOLD:
+            counts[incident_type] = content_counts[term]
+            logging.info(f"Incident count for '{incident_type}': {content_counts[term]} (content count, key phrases skipped)")
+        else:
+            found.append((incident_type, "\n\n".join(contents)))
+
+    if not found:
+        return [counts[incident_type] for incident_type in terms]
+
+    # Extract key phrases for every incident type that matched documents, batched across types
+    async with shared_async_transport() as transport, create_async_text_analytics_client(transport) as async_text_analytics_client:
+        key_phrases = await extract_key_phrases(async_text_analytics_client, [content for _, content in found], max_concurrency)
+
+    for (incident_type, _), phrases in zip(found, key_phrases):
+        term = terms[incident_type]
+        counts[incident_type] = count_incidents(incident_type, term, content_counts[term], phrases)
+    return [counts[incident_type] for incident_type in terms]
 
 def load_incident_types():
     logging.info(f"Loading incident types from {CONFIG_FILE}")
     try:
-        with open(CONFIG_FILE, 'r') as f:
-            incident_types = json.load(f)
-        
-        # Create a new dictionary with modified keys
-        modified_incident_types = {}
-        for term, count in incident_types.items():
-            if ' ' in term:
-                modified_incident_types[f'"""{term}"""'] = count
-            else:
-                modified_incident_types[term] = count
+        with open(CONFIG_FILE, 'rb') as f:
+            incident_types = orjson.loads(f.read())
         
-        return modified_incident_types
+        # Lowercase each incident type once; counting matches against the lowercased corpus
+        return {name: (count, name.lower()) for name, count in incident_types.items()}
     except Exception as e:
         logging.error(f"Error loading incident types: {str(e)}")
         raise
@@ -158,17 +148,16 @@ def generate_report(results, output_file):
         
         # Save JSON report
         json_file = f"{os.path.splitext(output_file)[0]}_{timestamp}.json"
-        with open(json_file, 'w') as f:
-            json.dump(results, f, indent=2)
+        with open(json_file, 'wb') as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
         logging.info(f"JSON report saved successfully to {json_file}")
 
         # Save CSV report
         csv_file = f"{os.path.splitext(output_file)[0]}_{timestamp}.csv"
         with open(csv_file, 'w', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=['name', 'ground_truth_count', 'discovered_count'])
-            writer.writeheader()
-            for row in results:
-                writer.writerow(row)
+            writer = csv.writer(f)
+            writer.writerow(['name', 'ground_truth_count', 'discovered_count'])
+            writer.writerows((row['name'], row['ground_truth_count'], row['discovered_count']) for row in results)
         logging.info(f"CSV report saved successfully to {csv_file}")
 
     except Exception as e:
@@ -180,26 +169,32 @@ def main():
     
     parser = argparse.ArgumentParser(description="Analyze incident reports using Azure AI services.")
     parser.add_argument("--output", default="reports/terms_discovered.json", help="Output file for the report (JSON and CSV)")
+    parser.add_argument("--skip-index", action="store_true", help="Count incidents from the local documents without re-indexing them")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY, help="Maximum number of concurrent Text Analytics requests")
     args = parser.parse_args()
 
+    # The search settings are only needed to index the documents
+    required_settings = TEXT_ANALYTICS_SETTINGS if args.skip_index else SEARCH_SETTINGS + TEXT_ANALYTICS_SETTINGS
+    if not check_settings(*required_settings):
+        return
+
     try:
-        # Read and index documents
-        logging.info("Starting document indexing process")
-        read_and_index_documents(DATA_DIR)
-        logging.info("Document indexing process completed")
+        if args.skip_index:
+            logging.info(f"Skipping indexing, reading documents from {DATA_DIR}")
+            documents = read_documents(DATA_DIR)
+        else:
+            # Documents are indexed as they are streamed into the counting pass below
+            documents = read_and_index_documents(DATA_DIR, INDEX_NAME)
 
         # Load incident types
         logging.info("Loading incident types")
         incident_types = load_incident_types()
         logging.info(f"Loaded {len(incident_types)} incident types")
 
-        results = []
-        for incident_type, ground_truth_count in incident_types.items():
-            logging.info(f"Processing incident type: '{incident_type}'")
-            
-            # Count incidents
-            discovered_count = count_incidents(incident_type)
+        discovered_counts = asyncio.run(count_all_incidents(incident_types, documents, args.max_concurrency))
 
+        results = []
+        for (incident_type, (ground_truth_count, _)), discovered_count in zip(incident_types.items(), discovered_counts):
             results.append({
                 "name": incident_type,
                 "ground_truth_count": ground_truth_count,
@@ -220,4 +215,5 @@ def main():
         print(f"An error occurred. Please check the logs for details.")
 
 if __name__ == "__main__":
+    setup_logging()
     main()
\ No newline at end of file
@@ -1,84 +1,58 @@
-import os
 import logging
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from openai import AzureOpenAI
-from dotenv import load_dotenv
 import argparse
-
-# Load environment variables
-load_dotenv()
-
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from clients import throttle_retry, check_settings, SEARCH_SETTINGS, OPENAI_SETTINGS, get_search_client, get_openai_client, get_openai_deployment
+from util import setup_logging, select_contents, SYSTEM_MESSAGE, USER_PROMPT_TEMPLATE
+import count_cache
 
 # Global variables
 INDEX_NAME = "incident-small"
 
-# Azure AI Search configuration
-search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
-search_key = os.getenv("AZURE_SEARCH_KEY")
-logging.info(f"Azure Search Endpoint: {search_endpoint}")
-logging.info(f"Azure Search Key: {'*' * len(search_key) if search_key else 'Not found'}")
-
-# Azure OpenAI configuration
-openai_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-openai_key = os.getenv("AZURE_OPENAI_KEY")
-openai_deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-logging.info(f"Azure OpenAI Endpoint: {openai_endpoint}")
-logging.info(f"Azure OpenAI Key: {'*' * len(openai_key) if openai_key else 'Not found'}")
-logging.info(f"Azure OpenAI Deployment: {openai_deployment}")
+@throttle_retry
+def search_contents(query_incident):
+    # Search for relevant documents, keeping only their content as the pages stream in
+    return [doc['content'] for doc in get_search_client(INDEX_NAME).search(query_incident, top=100, select=["content"], search_fields=["content"])]
 
-try:
-    search_credential = AzureKeyCredential(search_key)
-    logging.info("Azure Search credential created successfully")
-except ValueError as e:
-    logging.error(f"Error creating Azure Search credential: {str(e)}")
-    raise
-
-try:
-    # Initialize clients
-    search_client = SearchClient(endpoint=search_endpoint, index_name=INDEX_NAME, credential=search_credential)
-    openai_client = AzureOpenAI(
-        api_key=openai_key,
-        api_version="2023-05-15",
-        azure_endpoint=openai_endpoint
+@throttle_retry
+def request_count(query_incident, combined_content):
+    # Use Azure OpenAI to analyze the content
+    user_message = USER_PROMPT_TEMPLATE.format(query_incident=query_incident, combined_content=combined_content)
+    
+    return get_openai_client().chat.completions.create(
+        model=get_openai_deployment(),
+        messages=[
+            {"role": "system", "content": SYSTEM_MESSAGE},
+            {"role": "user", "content": user_message}
+        ],
+        temperature=0,
+        max_tokens=10
     )
-    logging.info("Azure clients initialized successfully")
-except Exception as e:
-    logging.error(f"Error initializing Azure clients: {str(e)}")
-    raise
 
 def count_incidents(query_incident):
     logging.info(f"Counting incidents for query: '{query_incident}'")
     try:
-        # Search for relevant documents, increase top to 50
-        results = list(search_client.search(query_incident, top=100))
-        logging.info(f"Found {len(results)} relevant documents")
+        # Counts are deterministic (temperature 0), so a repeat query is answered from the on-disk cache
+        cache_key = count_cache.make_key(INDEX_NAME, query_incident, SYSTEM_MESSAGE, USER_PROMPT_TEMPLATE, get_openai_deployment())
+        count = count_cache.get_count(cache_key)
+        if count is not None:
+            logging.info(f"Incident count for '{query_incident}': {count} (cached)")
+            return count
         
-        if not results:
+        contents = search_contents(query_incident)
+        logging.info(f"Found {len(contents)} relevant documents")
+        
+        if not contents:
             logging.info(f"No documents found for query: '{query_incident}'")
             return 0
         
-        # Combine relevant documents
-        combined_content = "\n\n".join([doc['content'] for doc in results])
-        logging.info(f"Combined content length: {len(combined_content)} characters")
-        
-        # Use Azure OpenAI to analyze the content
-        system_message = "You are an AI assistant tasked with analyzing incident reports. Your job is to count the number of distinct incidents related to a specific query."
-        user_message = f"Based on the following incident reports, how many distinct incidents related to '{query_incident}' can you identify? Please provide only a number as your response.\n\nIncident reports:\n{combined_content}"
-        
-        response = openai_client.chat.completions.create(
-            model=openai_deployment,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ],
-            temperature=0,
-            max_tokens=10
-        )
+        # Combine the excerpts of the relevant documents that mention the incident type
+        contents = select_contents(query_incident, contents)
+        logging.info(f"Kept {len(contents)} excerpts for the prompt")
+        combined_content = "\n---\n".join(contents)
+        logging.info("Combined content length: %d characters", len(combined_content))
         
+        response = request_count(query_incident, combined_content)
         count = int(response.choices[0].message.content.strip())
+        count_cache.set_count(cache_key, count)
         
         logging.info(f"Incident count for '{query_incident}': {count}")
         return count
@@ -93,6 +67,9 @@ def main():
     parser.add_argument("incident_type", type=str, nargs='?', help="The type of incident to query for (use quotes for composite terms)")
     args = parser.parse_args()
 
+    if not check_settings(*SEARCH_SETTINGS, *OPENAI_SETTINGS):
+        return
+
     try:
         # Check if incident_type is provided
         if args.incident_type is None:
@@ -117,4 +94,5 @@ def main():
         print(f"An error occurred. Please check the logs for details.")
 
 if __name__ == "__main__":
+    setup_logging()
     main()
\ No newline at end of file
@@ -1,113 +1,136 @@
 import os
-import json
+import orjson
 import csv
 import logging
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from openai import AzureOpenAI
-from dotenv import load_dotenv
+import asyncio
 import argparse
 from datetime import datetime
-
-# Load environment variables
-load_dotenv()
-
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from operator import itemgetter
+from clients import throttle_retry, check_settings, SEARCH_SETTINGS, OPENAI_SETTINGS, get_openai_deployment, create_async_search_client, create_async_openai_client, shared_async_transport
+from util import setup_logging, select_contents, SYSTEM_MESSAGE, USER_PROMPT_TEMPLATE
+import count_cache
 
 # Global variables
 INDEX_NAME = "incident-small"
-
-# Azure AI Search configuration
-search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
-search_key = os.getenv("AZURE_SEARCH_KEY")
-logging.info(f"Azure Search Endpoint: {search_endpoint}")
-logging.info(f"Azure Search Key: {'*' * len(search_key) if search_key else 'Not found'}")
-
-# Azure OpenAI configuration
-openai_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-openai_key = os.getenv("AZURE_OPENAI_KEY")
-openai_deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-logging.info(f"Azure OpenAI Endpoint: {openai_endpoint}")
-logging.info(f"Azure OpenAI Key: {'*' * len(openai_key) if openai_key else 'Not found'}")
-logging.info(f"Azure OpenAI Deployment: {openai_deployment}")
-
-# Initialize clients
-try:
-    search_credential = AzureKeyCredential(search_key)
-    search_client = SearchClient(endpoint=search_endpoint, index_name=INDEX_NAME, credential=search_credential)
-    openai_client = AzureOpenAI(
-        api_key=openai_key,
-        api_version="2023-05-15",
-        azure_endpoint=openai_endpoint
+MAX_CONCURRENCY = 8
+
+@throttle_retry
+async def search_contents(async_search_client, query_incident):
+    # Search for relevant documents, keeping only their content as the pages stream in
+    results = await async_search_client.search(query_incident, top=100, select=["content"], search_fields=["content"])
+    return [doc['content'] async for doc in results]
+
+@throttle_retry
+async def request_count(async_openai_client, query_incident, combined_content):
+    # Use Azure OpenAI to analyze the content
+    user_message = USER_PROMPT_TEMPLATE.format(query_incident=query_incident, combined_content=combined_content)
+    
+    return await async_openai_client.chat.completions.create(
+        model=get_openai_deployment(),
+        messages=[
+            {"role": "system", "content": SYSTEM_MESSAGE},
+            {"role": "user", "content": user_message}
+        ],
+        temperature=0,
+        max_tokens=10
     )
-    logging.info("Azure clients initialized successfully")
-except Exception as e:
-    logging.error(f"Error initializing Azure clients: {str(e)}")
-    raise
 
-def count_incidents(query_incident):
-    logging.info(f"Counting incidents for query: '{query_incident}'")
-    try:
-        # Search for relevant documents, increase top to 50
-        results = list(search_client.search(query_incident, top=100))
-        logging.info(f"Found {len(results)} relevant documents")
-        
-        if not results:
-            logging.info(f"No documents found for query: '{query_incident}'")
-            return 0
-        
-        # Combine relevant documents
-        combined_content = "\n\n".join([doc['content'] for doc in results])
-        logging.info(f"Combined content length: {len(combined_content)} characters")
-        
-        # Use Azure OpenAI to analyze the content
-        system_message = "You are an AI assistant tasked with analyzing incident reports. Your job is to count the number of distinct incidents related to a specific query."
-        user_message = f"Based on the following incident reports, how many distinct incidents related to '{query_incident}' can you identify? Please provide only a number as your response.\n\nIncident reports:\n{combined_content}"
-        
-        response = openai_client.chat.completions.create(
-            model=openai_deployment,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ],
-            temperature=0,
-            max_tokens=10
-        )
-        
-        count = int(response.choices[0].message.content.strip())
-        
-        logging.info(f"Incident count for '{query_incident}': {count}")
-        return count
-    except Exception as e:
-        logging.error(f"Error in count_incidents: {str(e)}")
-        return 0  # Return 0 instead of raising an exception
+async def count_incidents(async_search_client, async_openai_client, semaphore, query_incident):
+    async with semaphore:
+        logging.info(f"Counting incidents for query: '{query_incident}'")
+        try:
+            # Counts are deterministic (temperature 0), so a repeat query is answered from the on-disk cache
+            cache_key = count_cache.make_key(INDEX_NAME, query_incident, SYSTEM_MESSAGE, USER_PROMPT_TEMPLATE, get_openai_deployment())
+            count = count_cache.get_count(cache_key)
+            if count is not None:
+                logging.info(f"Incident count for '{query_incident}': {count} (cached)")
+                return count
+            
+            contents = await search_contents(async_search_client, query_incident)
+            logging.info(f"Found {len(contents)} relevant documents")
+            
+            if not contents:
+                logging.info(f"No documents found for query: '{query_incident}'")
+                return 0
+            
+            # Combine the excerpts of the relevant documents that mention the incident type
+            contents = select_contents(query_incident, contents)
+            logging.info(f"Kept {len(contents)} excerpts for the prompt")
+            combined_content = "\n---\n".join(contents)
+            logging.info("Combined content length: %d characters", len(combined_content))
+            
+            response = await request_count(async_openai_client, query_incident, combined_content)
+            count = int(response.choices[0].message.content.strip())
+            count_cache.set_count(cache_key, count)
+            
+            logging.info(f"Incident count for '{query_incident}': {count}")
+            return count
+        except Exception as e:
+            logging.error(f"Error in count_incidents: {str(e)}")
+            return 0  # Return 0 instead of raising an exception
 
 def load_incident_types():
     try:
-        with open('config/incident_type_distribution.json', 'r') as f:
-            return json.load(f)
+        with open('config/incident_type_distribution.json', 'rb') as f:
+            return orjson.loads(f.read())
     except Exception as e:
         logging.error(f"Error loading incident types: {str(e)}")
         raise
 
-def generate_report(results, output_dir):
+async def warm_up(async_search_client, async_openai_client):
+    # Open the connections before the counts start so the first searches skip the TCP and TLS handshake.
+    # OpenAI is only warmed when AZURE_OPENAI_PREWARM is set, since it adds a call that is otherwise unnecessary.
+    try:
+        await async_search_client.get_document_count()
+        if os.getenv("AZURE_OPENAI_PREWARM"):
+            await async_openai_client.models.list()
+    except Exception as e:
+        logging.warning(f"Connection warm-up failed: {str(e)}")
+
+async def analyze_incident_types(incident_types, max_concurrency=MAX_CONCURRENCY):
+    # Every incident type is counted concurrently, at most max_concurrency at a time. Results are yielded by
+    # ground_truth_count in descending order, each as soon as it and every type ahead of it have finished.
+    ordered = sorted(incident_types.items(), key=itemgetter(1), reverse=True)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async with shared_async_transport() as transport, \
+            create_async_search_client(INDEX_NAME, transport, retry_total=0) as async_search_client, \
+            create_async_openai_client() as async_openai_client:
+        await warm_up(async_search_client, async_openai_client)
+        tasks = [
+            asyncio.create_task(count_incidents(async_search_client, async_openai_client, semaphore, incident_type))
+            for incident_type, _ in ordered
+        ]
+        for (incident_type, ground_truth_count), task in zip(ordered, tasks):
+            discovered_count = await task
+
+            logging.info(f"Analysis complete for '{incident_type}'. Ground truth: {ground_truth_count}, Discovered: {discovered_count}")
+            yield {
+                "name": incident_type,
+                "ground_truth_count": ground_truth_count,
+                "discovered_count": discovered_count
+            }
+
+async def generate_report(results, output_dir):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     # Ensure the output directory exists
     os.makedirs(output_dir, exist_ok=True)
     
-    # Generate JSON report
-    json_filename = os.path.join(output_dir, f"incident_analysis_{timestamp}.json")
-    with open(json_filename, 'w') as f:
-        json.dump(results, f, indent=2)
-    
-    # Generate CSV report with the new filename format
+    # Generate CSV report with the new filename format, writing each row as soon as it is produced
     csv_filename = os.path.join(output_dir, f"openai_report_{timestamp}.csv")
+    written = []
     with open(csv_filename, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=["name", "ground_truth_count", "discovered_count"])
-        writer.writeheader()
-        writer.writerows(results)
+        writer = csv.writer(f)
+        writer.writerow(("name", "ground_truth_count", "discovered_count"))
+        async for row in results:
+            writer.writerow((row["name"], row["ground_truth_count"], row["discovered_count"]))
+            f.flush()
+            written.append(row)
+    
+    # Generate JSON report
+    json_filename = os.path.join(output_dir, f"incident_analysis_{timestamp}.json")
+    with open(json_filename, 'wb') as f:
+        f.write(orjson.dumps(written, option=orjson.OPT_INDENT_2))
     
     logging.info(f"Reports generated: {json_filename} and {csv_filename}")
     return csv_filename  # Return the CSV filename for potential use in main()
@@ -117,34 +140,20 @@ def main():
     
     parser = argparse.ArgumentParser(description="Analyze incident reports using Azure AI services.")
     parser.add_argument("--output", type=str, default="reports", help="Output directory for reports")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY, help="Maximum number of incident types counted at once")
     args = parser.parse_args()
 
+    if not check_settings(*SEARCH_SETTINGS, *OPENAI_SETTINGS):
+        return
+
     try:
         # Load incident types
         incident_types = load_incident_types()
         logging.info(f"Loaded {len(incident_types)} incident types")
 
-        results = []
-        for incident_type, ground_truth_count in incident_types.items():
-            logging.info(f"Processing incident type: '{incident_type}'")
-            
-            # Count incidents
-            discovered_count = count_incidents(incident_type)
-
-            results.append({
-                "name": incident_type,
-                "ground_truth_count": ground_truth_count,
-                "discovered_count": discovered_count
-            })
-
-            logging.info(f"Analysis complete for '{incident_type}'. Ground truth: {ground_truth_count}, Discovered: {discovered_count}")
-
-        # Sort results by ground_truth_count in descending order
-        results.sort(key=lambda x: x['ground_truth_count'], reverse=True)
-
-        # Generate report
+        # Generate report, counting each incident type as the report consumes it
         logging.info("Generating final report")
-        csv_filename = generate_report(results, args.output)
+        csv_filename = asyncio.run(generate_report(analyze_incident_types(incident_types, args.max_concurrency), args.output))
 
         logging.info("Analysis complete for all incident types.")
         print(f"Analysis complete. Reports saved with timestamp.")
@@ -155,4 +164,5 @@ def main():
         print(f"An error occurred. Please check the logs for details.")
 
 if __name__ == "__main__":
+    setup_logging()
     main()
\ No newline at end of file
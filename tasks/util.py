@@ -0,0 +1,43 @@
+import base64
+import logging
+import re
+from functools import lru_cache
+
+# Roughly 16K tokens of incident reports per prompt
+MAX_PROMPT_CHARS = 64000
+# Characters kept on each side of a query match, and the most excerpts sent per prompt
+SNIPPET_RADIUS = 200
+MAX_SNIPPETS = 100
+# Content counts at or above this already dominate the key-phrase count, so Text Analytics is skipped
+CONTENT_COUNT_THRESHOLD = 10
+# Counting prompts shared by query_azureai and query_azureai_all; both are part of the count cache key
+SYSTEM_MESSAGE = "You are an AI assistant tasked with analyzing incident reports. Your job is to count the number of distinct incidents related to a specific query."
+USER_PROMPT_TEMPLATE = "Based on the following excerpts from incident reports, how many distinct incidents related to '{query_incident}' can you identify? Please provide only a number as your response.\n\nIncident report excerpts:\n{combined_content}"
+
+@lru_cache(maxsize=None)
+def encode_filename(filename):
+    # Remove the extension, encode to bytes, then to base64; the output is always ASCII
+    stem = filename.rpartition('.')[0]
+    return base64.urlsafe_b64encode(stem.encode()).decode('ascii')
+
+def setup_logging():
+    # basicConfig only configures the root logger once, so every entry point can call this safely
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+def select_contents(query_incident, contents):
+    # Keep a deduplicated window around each match of the query instead of the full hits,
+    # falling back to every hit when none matches, and stop once the prompt budget is used up
+    snippet_pattern = re.compile(
+        rf".{{0,{SNIPPET_RADIUS}}}\b{re.escape(query_incident)}.{{0,{SNIPPET_RADIUS}}}",
+        re.IGNORECASE | re.DOTALL
+    )
+    snippets = dict.fromkeys(snippet for content in contents for snippet in snippet_pattern.findall(content))
+    candidates = list(snippets)[:MAX_SNIPPETS] or contents
+    selected = []
+    total_chars = 0
+    for content in candidates:
+        total_chars += len(content) + 2
+        if selected and total_chars > MAX_PROMPT_CHARS:
+            break
+        selected.append(content)
+    return selected